@@ -1,6 +1,10 @@
 from .imports import *
 from .layer_optimizer import *
-import copy
+from scipy.signal import lfilter
+from queue import Queue
+
+# Switch to a non-interactive backend once, rather than per plot call
+if not in_ipynb(): plt.switch_backend('agg')
 
 
 class Callback:
@@ -15,89 +19,155 @@ class Callback:
 # Usage:
 # learn.fit(0.01, 1, callbacks = [LoggingCallback(save_path="/tmp/log")])
 class LoggingCallback(Callback):
-    def __init__(self, save_path):
+    def __init__(self, save_path, verbose_batch=True):
         super().__init__()
-        self.save_path=save_path
+        self.save_path,self.verbose_batch=save_path,verbose_batch
     def on_train_begin(self):
         self.batch = 0
         self.epoch = 0
-        self.f = open(self.save_path, "a", 1)
+        self.f = open(self.save_path, "a", 1<<16)
+        self.q = Queue(maxsize=1024)
+        self.worker = threading.Thread(target=self.write_loop, daemon=True)
+        self.worker.start()
         self.log("\ton_train_begin")
     def on_batch_begin(self):
-        self.log(str(self.batch)+"\ton_batch_begin")
+        if self.verbose_batch: self.log(str(self.batch)+"\ton_batch_begin")
     def on_epoch_end(self, metrics):
         self.log(str(self.epoch)+"\ton_epoch_end: "+str(metrics))
         self.epoch += 1
     def on_batch_end(self, metrics):
-        self.log(str(self.batch)+"\ton_batch_end: "+str(metrics))
+        if self.verbose_batch: self.log(str(self.batch)+"\ton_batch_end: "+str(metrics))
         self.batch += 1
     def on_train_end(self):
         self.log("\ton_train_end")
+        self.q.put(None)
+        self.worker.join()
         self.f.close()
     def log(self, string):
-        self.f.write(time.strftime("%Y-%m-%dT%H:%M:%S")+"\t"+string+"\n")
+        self.q.put((time.time(), string))
+    def write_loop(self):
+        # Drains the queue off the training thread; timestamps are memoized per second
+        last_sec,stamp = None,''
+        while True:
+            msg = self.q.get()
+            if msg is None: break
+            t,string = msg
+            sec = int(t)
+            if sec != last_sec:
+                last_sec,stamp = sec,time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(sec))
+            self.f.write(stamp+"\t"+string+"\n")
 
 class LossRecorder(Callback):
     def __init__(self, layer_opt, save_path='', record_mom=False, metrics=[]):
         super().__init__()
         self.layer_opt=layer_opt
-        self.init_lrs=np.array(layer_opt.lrs)
+        # Contiguous, read-only float32: cheap broadcast operand for every calc_lr
+        self.init_lrs=np.ascontiguousarray(layer_opt.lrs, dtype=np.float32)
+        self.init_lrs.flags.writeable=False
         self.save_path, self.record_mom, self.metrics = save_path, record_mom, metrics
 
     def on_train_begin(self):
-        self.losses,self.lrs,self.iterations = [],[],[]
-        self.val_losses, self.rec_metrics = [], []
-        if self.record_mom:
-            self.momentums = []
+        nb = getattr(self, 'nb', None)
+        if nb:
+            # Preallocate contiguous storage when the schedule length is known
+            self.losses,self.lrs = np.empty(nb, dtype=np.float32),np.empty(nb, dtype=np.float32)
+            self.iterations = np.empty(nb, dtype=np.int32)
+            if self.record_mom: self.momentums = np.empty(nb, dtype=np.float32)
+        else:
+            self.losses,self.lrs,self.iterations = [],[],[]
+            if self.record_mom: self.momentums = []
+        # rec_metrics is sized lazily on the array path, once the metric count is known
+        self.val_losses, self.rec_metrics = [], None if getattr(self, 'nb', None) else []
         self.iteration = 0
         self.epoch = 0
+        self._n = 0
+        self.store = self.store_array if nb else self.store_list
+        self.record_batch = self.specialize_record
 
     def on_epoch_end(self, metrics):
         self.epoch += 1
 
     def on_batch_end(self, loss):
         self.iteration += 1
-        self.lrs.append(self.layer_opt.lr)
+        self.record_batch(loss)
+
+    def specialize_record(self, loss):
+        # Bind the matching recorder once; fit passes the same loss shape every batch
+        self.record_batch = self.record_metrics_batch if isinstance(loss, list) else self.store
+        self.record_batch(loss)
+
+    def record_metrics_batch(self, loss):
+        self.save_metrics(loss[1:])
+        self.store(loss[0])
+
+    def store_array(self, l):
+        if self._n == len(self.losses): self.grow_rec()
+        self.lrs[self._n],self.iterations[self._n] = self.read_lr(),self.iteration
+        self.losses[self._n] = l
+        if self.record_mom: self.momentums[self._n] = self.read_mom()
+        self._n += 1
+
+    def store_list(self, l):
+        self.lrs.append(self.read_lr())
         self.iterations.append(self.iteration)
-        if isinstance(loss, list):
-            self.losses.append(loss[0])
-            self.save_metrics(loss[1:])
-        else: self.losses.append(loss)
-        if self.record_mom: self.momentums.append(self.layer_opt.mom)
+        self.losses.append(l)
+        if self.record_mom: self.momentums.append(self.read_mom())
+        self._n += 1
+
+    # Recorders that don't drive the schedule must see whatever the driver set
+    def read_lr(self): return self.layer_opt.lr
+    def read_mom(self): return self.layer_opt.mom
+
+    def grow_rec(self):
+        # Restarting cycles (cycle_mult>1) can outrun the initial nb
+        self.losses = np.concatenate([self.losses, np.empty_like(self.losses)])
+        self.lrs = np.concatenate([self.lrs, np.empty_like(self.lrs)])
+        self.iterations = np.concatenate([self.iterations, np.empty_like(self.iterations)])
+        if self.record_mom: self.momentums = np.concatenate([self.momentums, np.empty_like(self.momentums)])
 
     def save_metrics(self,vals):
         self.val_losses.append(vals[0])
-        if len(vals) > 2: self.rec_metrics.append(vals[1:])
-        elif len(vals) == 2: self.rec_metrics.append(vals[1])
+        if len(vals) < 2: return
+        if isinstance(self.losses, np.ndarray):
+            if self.rec_metrics is None:
+                self.rec_metrics = np.empty((len(self.losses), len(vals)-1), dtype=np.float32)
+            if self._n == len(self.rec_metrics):
+                self.rec_metrics = np.concatenate([self.rec_metrics, np.empty_like(self.rec_metrics)])
+            self.rec_metrics[self._n] = vals[1:]
+        elif len(vals) > 2: self.rec_metrics.append(vals[1:])
+        else: self.rec_metrics.append(vals[1])
 
     def plot_loss(self, n_skip=10, n_skip_end=5):
-        if not in_ipynb(): plt.switch_backend('agg')
-        plt.plot(self.iterations[n_skip:-n_skip_end], self.losses[n_skip:-n_skip_end])
+        plt.plot(self.iterations[n_skip:self._n-n_skip_end], self.losses[n_skip:self._n-n_skip_end])
         if not in_ipynb():
             plt.savefig(os.path.join(self.save_path, 'loss_plot.png'))
-            np.save(os.path.join(self.save_path, 'losses.npy'), self.losses[10:])
+            np.save(os.path.join(self.save_path, 'losses.npy'), self.losses[10:self._n])
 
     def plot_lr(self):
-        if not in_ipynb():
-            plt.switch_backend('agg')
         if self.record_mom:
             fig, axs = plt.subplots(1,2,figsize=(12,4))
             for i in range(0,2): axs[i].set_xlabel('iterations')
             axs[0].set_ylabel('learning rate')
             axs[1].set_ylabel('momentum')
-            axs[0].plot(self.iterations,self.lrs)
-            axs[1].plot(self.iterations,self.momentums)   
+            axs[0].plot(self.iterations[:self._n],self.lrs[:self._n])
+            axs[1].plot(self.iterations[:self._n],self.momentums[:self._n])
+            if not in_ipynb():
+                fig.savefig(os.path.join(self.save_path, 'lr_plot.png'))
         else:
             plt.xlabel("iterations")
             plt.ylabel("learning rate")
-            plt.plot(self.iterations, self.lrs)
-        if not in_ipynb():
-            plt.savefig(os.path.join(self.save_path, 'lr_plot.png'))
+            plt.plot(self.iterations[:self._n], self.lrs[:self._n])
+            if not in_ipynb():
+                plt.savefig(os.path.join(self.save_path, 'lr_plot.png'))
 
 
 class LR_Updater(LossRecorder):
     def on_train_begin(self):
         super().on_train_begin()
+        self._lrs_out = np.empty_like(self.init_lrs, dtype=np.float64)
+        # Bind the per-batch call targets once to skip the attribute chains in update_lr
+        self._calc_lr,self._set_lrs = self.calc_lr,self.layer_opt.set_lrs
+        self._calc_mom,self._set_mom = self.calc_mom,self.layer_opt.set_mom
         self.update_lr()
         if self.record_mom:
             self.update_mom()
@@ -110,16 +180,31 @@ class LR_Updater(LossRecorder):
         return res
 
     def update_lr(self):
-        new_lrs = self.calc_lr(self.init_lrs)
-        self.layer_opt.set_lrs(new_lrs)
+        new_lrs = self._calc_lr(self.init_lrs)
+        self._set_lrs(new_lrs)
+        self._last_lr = new_lrs[-1]
+
+    def scale_lrs(self, init_lrs, mult):
+        # One reused output buffer; set_lrs consumes the values before the next update
+        return np.multiply(init_lrs, mult, out=self._lrs_out)
+
+    def on_train_end(self):
+        # set_lrs keeps a reference to what it is given; hand the optimizer its own
+        # copy so its public lrs no longer alias the per-batch scratch buffer
+        self.layer_opt.set_lrs(np.array(self._lrs_out))
     
     def update_mom(self):
-        new_mom = self.calc_mom()
-        self.layer_opt.set_mom(new_mom)
+        new_mom = self._calc_mom()
+        self._set_mom(new_mom)
+        self._last_mom = new_mom
+
+    # The updater just set these itself, so it can skip the layer_opt property walk
+    def read_lr(self): return self._last_lr
+    def read_mom(self): return self._last_mom
 
     @abstractmethod
     def calc_lr(self, init_lrs): raise NotImplementedError
-    
+
     @abstractmethod
     def calc_mom(self): raise NotImplementedError
 
@@ -132,16 +217,20 @@ class LR_Finder(LR_Updater):
         super().__init__(layer_opt,metrics=metrics)
 
     def on_train_begin(self):
+        self._cur_mult = 1.
         super().on_train_begin()
         self.best=1e9
 
     def calc_lr(self, init_lrs):
-        mult = self.lr_mult*self.iteration if self.linear else self.lr_mult**self.iteration
-        return init_lrs * mult
+        if self.linear: return self.scale_lrs(init_lrs, self.lr_mult * self.iteration)
+        res = self.scale_lrs(init_lrs, self._cur_mult)
+        self._cur_mult *= self.lr_mult
+        return res
 
     def on_batch_end(self, metrics):
         loss = metrics[0] if isinstance(metrics,list) else metrics
-        if self.stop_dv and (math.isnan(loss) or loss>self.best*4):
+        # A NaN loss fails the comparison too, so one check covers both stop conditions
+        if self.stop_dv and not (loss<=self.best*4):
             return True
         if (loss<self.best and self.iteration>10): self.best=loss
         return super().on_batch_end(metrics)
@@ -149,7 +238,7 @@ class LR_Finder(LR_Updater):
     def plot(self, n_skip=10, n_skip_end=5):
         plt.ylabel("loss")
         plt.xlabel("learning rate (log scale)")
-        plt.plot(self.lrs[n_skip:-n_skip_end], self.losses[n_skip:-n_skip_end])
+        plt.plot(self.lrs[n_skip:self._n-n_skip_end], self.losses[n_skip:self._n-n_skip_end])
         plt.xscale('log')
 
 class LR_Finder2(LR_Finder):
@@ -170,17 +259,14 @@ class LR_Finder2(LR_Finder):
         for i in range(0,n_plots): axs[i].set_xlabel('learning rate')
         axs[0].set_ylabel('training loss')
         axs[1].set_ylabel('validation loss')
-        for i,m in enumerate(self.metrics): 
+        for i,m in enumerate(self.metrics):
             axs[i+2].set_ylabel(m.__name__)
-            if len(self.metrics) == 1:
-                values = self.rec_metrics
-            else:
-                values = [rec[i] for rec in self.rec_metrics]
+            values = self.rec_metrics[:self._n, i] if self.rec_metrics is not None else []
             if smoothed: values = smooth_curve(values,0.98)
-            axs[i+2].plot(self.lrs[n_skip:-n_skip_end], values[n_skip:-n_skip_end])
+            axs[i+2].plot(self.lrs[n_skip:self._n-n_skip_end], values[n_skip:-n_skip_end])
         plt_val_l = smooth_curve(self.val_losses, 0.98) if smoothed else self.val_losses
-        axs[0].plot(self.lrs[n_skip:-n_skip_end],self.losses[n_skip:-n_skip_end])
-        axs[1].plot(self.lrs[n_skip:-n_skip_end],plt_val_l[n_skip:-n_skip_end])
+        axs[0].plot(self.lrs[n_skip:self._n-n_skip_end],self.losses[n_skip:self._n-n_skip_end])
+        axs[1].plot(self.lrs[n_skip:self._n-n_skip_end],plt_val_l[n_skip:-n_skip_end])
 
 class CosAnneal(LR_Updater):
     def __init__(self, layer_opt, nb, on_cycle_end=None, cycle_mult=1):
@@ -189,21 +275,29 @@ class CosAnneal(LR_Updater):
 
     def on_train_begin(self):
         self.cycle_iter,self.cycle_count=0,0
+        self.build_lr_table()
         super().on_train_begin()
 
+    def build_lr_table(self):
+        self.lr_table = ((np.cos(np.pi*np.arange(self.nb)/self.nb) + 1) / 2).astype(np.float32)
+
     def calc_lr(self, init_lrs):
         if self.iteration<self.nb/20:
             self.cycle_iter += 1
-            return init_lrs/100.
+            return self.scale_lrs(init_lrs, 0.01)
 
-        cos_out = np.cos(np.pi*(self.cycle_iter)/self.nb) + 1
+        # The warmup branch can push cycle_iter past nb for tiny cycles; fall back
+        # to the direct cosine there, as the pre-table code did
+        if self.cycle_iter < self.nb: mult = self.lr_table[self.cycle_iter]
+        else: mult = (np.cos(np.pi*self.cycle_iter/self.nb) + 1) / 2
         self.cycle_iter += 1
         if self.cycle_iter==self.nb:
             self.cycle_iter = 0
             self.nb *= self.cycle_mult
+            self.build_lr_table()
             if self.on_cycle_end: self.on_cycle_end(self, self.cycle_count)
             self.cycle_count += 1
-        return init_lrs / 2 * cos_out
+        return self.scale_lrs(init_lrs, mult)
 
 
 class CircularLR(LR_Updater):
@@ -215,28 +309,48 @@ class CircularLR(LR_Updater):
 
     def on_train_begin(self):
         self.cycle_iter,self.cycle_count=0,0
+        self.build_tables()
         super().on_train_begin()
 
-    def calc_lr(self, init_lrs):
+    def build_tables(self):
         cut_pt = self.nb//self.cut_div
-        if self.cycle_iter>cut_pt:
-            pct = 1 - (self.cycle_iter - cut_pt)/(self.nb - cut_pt)
-        else: pct = self.cycle_iter/cut_pt
-        res = init_lrs * (1 + pct*(self.div-1)) / self.div
+        it = np.arange(self.nb)
+        pct = np.where(it>cut_pt, 1 - (it - cut_pt)/(self.nb - cut_pt), it/max(cut_pt,1))
+        self.lr_mult_tbl = ((1 + pct*(self.div-1)) / self.div).astype(np.float32)
+        if self.record_mom:
+            self.mom_tbl = (self.moms[1] + (1-pct) * (self.moms[0] - self.moms[1])).astype(np.float32)
+
+    def calc_lr(self, init_lrs):
+        res = self.scale_lrs(init_lrs, self.lr_mult_tbl[self.cycle_iter])
         self.cycle_iter += 1
         if self.cycle_iter==self.nb:
             self.cycle_iter = 0
             if self.on_cycle_end: self.on_cycle_end(self, self.cycle_count)
             self.cycle_count += 1
         return res
-    
+
     def calc_mom(self):
-        cut_pt = self.nb//self.cut_div
-        if self.cycle_iter>cut_pt:
-            pct = (self.cycle_iter - cut_pt)/(self.nb - cut_pt)
-        else: pct = 1 - self.cycle_iter/cut_pt
-        res = self.moms[1] + pct * (self.moms[0] - self.moms[1])
-        return res
+        return float(self.mom_tbl[self.cycle_iter])
+
+def _circ_beta_mult(cycle_iter, nb, cycle_nb, div):
+    if cycle_iter>2*cycle_nb:
+        pct = (cycle_iter - 2*cycle_nb)/(nb - 2*cycle_nb)
+        return (1 + pct*(1-100)/100) / div
+    if cycle_iter>cycle_nb: pct = 1 - (cycle_iter - cycle_nb)/cycle_nb
+    else: pct = cycle_iter/cycle_nb
+    return (1 + pct*(div-1)) / div
+
+def _circ_beta_mom(cycle_iter, cycle_nb, mom0, mom1):
+    if cycle_iter>2*cycle_nb: return mom0
+    if cycle_iter>cycle_nb: pct = 1 - (cycle_iter - cycle_nb)/cycle_nb
+    else: pct = cycle_iter/cycle_nb
+    return mom0 + pct * (mom1 - mom0)
+
+try:
+    from numba import njit
+    _circ_beta_mult = njit(cache=True, fastmath=True)(_circ_beta_mult)
+    _circ_beta_mom = njit(cache=True, fastmath=True)(_circ_beta_mom)
+except ImportError: pass
 
 class CircularLR_beta(LR_Updater):
     def __init__(self, layer_opt, nb, div=10, pct=10, on_cycle_end=None, momentums=None):
@@ -248,35 +362,39 @@ class CircularLR_beta(LR_Updater):
 
     def on_train_begin(self):
         self.cycle_iter,self.cycle_count=0,0
+        self.build_tables()
         super().on_train_begin()
 
+    def build_tables(self):
+        if self.nb > 1<<20:
+            # A table this long buys nothing; use the (jitted, when numba is around) scalar math
+            self.lr_mult_tbl = self.mom_tbl = None
+            return
+        it = np.arange(self.nb)
+        end = it>2*self.cycle_nb
+        pct_end = (it - 2*self.cycle_nb)/max(self.nb - 2*self.cycle_nb, 1)
+        pct_tri = np.where(it>self.cycle_nb, 1 - (it - self.cycle_nb)/self.cycle_nb, it/self.cycle_nb)
+        self.lr_mult_tbl = np.where(end, (1 + pct_end*(1-100)/100) / self.div,
+                                    (1 + pct_tri*(self.div-1)) / self.div).astype(np.float32)
+        if self.record_mom:
+            self.mom_tbl = np.where(end, self.moms[0],
+                                    self.moms[0] + pct_tri * (self.moms[1] - self.moms[0])).astype(np.float32)
+
     def calc_lr(self, init_lrs):
-        if self.cycle_iter>2 * self.cycle_nb:
-            pct = (self.cycle_iter - 2*self.cycle_nb)/(self.nb - 2*self.cycle_nb)
-            res = init_lrs * (1 + (pct * (1-100)/100)) / self.div 
-        elif self.cycle_iter>self.cycle_nb:
-            pct = 1 - (self.cycle_iter - self.cycle_nb)/self.cycle_nb
-            res = init_lrs * (1 + pct*(self.div-1)) / self.div
-        else: 
-            pct = self.cycle_iter/self.cycle_nb
-            res = init_lrs * (1 + pct*(self.div-1)) / self.div
+        mult = (_circ_beta_mult(self.cycle_iter, self.nb, self.cycle_nb, self.div)
+                if self.lr_mult_tbl is None else self.lr_mult_tbl[self.cycle_iter])
+        res = self.scale_lrs(init_lrs, mult)
         self.cycle_iter += 1
         if self.cycle_iter==self.nb:
             self.cycle_iter = 0
             if self.on_cycle_end: self.on_cycle_end(self, self.cycle_count)
             self.cycle_count += 1
         return res
-    
+
     def calc_mom(self):
-        if self.cycle_iter>2*self.cycle_nb:
-            res = self.moms[0]
-        elif self.cycle_iter>self.cycle_nb:
-            pct = 1 - (self.cycle_iter - self.cycle_nb)/self.cycle_nb
-            res = self.moms[0] + pct * (self.moms[1] - self.moms[0])
-        else: 
-            pct = self.cycle_iter/self.cycle_nb
-            res = self.moms[0] + pct * (self.moms[1] - self.moms[0])
-        return res
+        if self.mom_tbl is None:
+            return _circ_beta_mom(self.cycle_iter, self.cycle_nb, self.moms[0], self.moms[1])
+        return float(self.mom_tbl[self.cycle_iter])
 
 
 class SaveBestModel(LossRecorder):
@@ -302,32 +420,44 @@ class SaveBestModel(LossRecorder):
     """
     def __init__(self, model, layer_opt, metrics, name='best_model'):
         super().__init__(layer_opt)
-        self.name = name
+        self.name = str(name)
         self.model = model
         self.best_loss = None
         self.best_acc = None
         self.save_method = self.save_when_only_loss if metrics==None else self.save_when_acc
-        
+        self.saver = ThreadPoolExecutor(max_workers=1)
+        self.pending_save = None
+
+    def save_best(self):
+        # Snapshot the weights on the training thread, write them in the background;
+        # a newer best cancels any save still queued so only one write is in flight
+        state = {k: (v.cpu() if v.is_cuda else v.clone()) for k, v in self.model.model.state_dict().items()}
+        if self.pending_save is not None: self.pending_save.cancel()
+        self.pending_save = self.saver.submit(torch.save, state, self.model.get_model_path(self.name))
+
     def save_when_only_loss(self, metrics):
         loss = metrics[0]
         if self.best_loss == None or loss < self.best_loss:
             self.best_loss = loss
-            self.model.save(f'{self.name}')
-    
+            self.save_best()
+
     def save_when_acc(self, metrics):
         loss, acc = metrics[0], metrics[1]
         if self.best_acc == None or acc > self.best_acc:
             self.best_acc = acc
             self.best_loss = loss
-            self.model.save(f'{self.name}')
+            self.save_best()
         elif acc == self.best_acc and  loss < self.best_loss:
             self.best_loss = loss
-            self.model.save(f'{self.name}')
-        
+            self.save_best()
+
     def on_epoch_end(self, metrics):
         super().on_epoch_end(metrics)
         self.save_method(metrics)
 
+    def on_train_end(self):
+        if self.pending_save is not None: self.pending_save.result()
+
 
 class WeightDecaySchedule(Callback):
     def __init__(self, layer_opt, batch_per_epoch, cycle_len, cycle_mult, n_cycles, norm_wds=False, wds_sched_mult=None):
@@ -344,8 +474,10 @@ class WeightDecaySchedule(Callback):
 
         self.layer_opt = layer_opt
         self.batch_per_epoch = batch_per_epoch
-        self.init_wds = np.array(layer_opt.wds)  # Weights as set by user
-        self.init_lrs = np.array(layer_opt.lrs)  # Learning rates as set by user
+        self.init_wds = np.ascontiguousarray(layer_opt.wds, dtype=np.float32)  # Weights as set by user
+        self.init_lrs = np.ascontiguousarray(layer_opt.lrs, dtype=np.float32)  # Learning rates as set by user
+        self.init_wds.flags.writeable = False
+        self.init_lrs.flags.writeable = False
         self.new_wds = None                      # Holds the new weight decay factors, calculated in on_batch_begin()
         self.param_groups_old = None             # Caches the old parameter values in on_batch_begin()
         self.iteration = 0
@@ -362,52 +494,67 @@ class WeightDecaySchedule(Callback):
                 i += 1
             cycle_len *= cycle_mult
 
+        # Normalized wds are constant within an epoch, so compute them up front
+        if norm_wds:
+            self.epoch_wdn = {e: self.init_wds / np.sqrt(batch_per_epoch * c)
+                              for e, c in self.epoch_to_num_cycles.items()}
+        self.zero_wds = torch.zeros(self.init_wds.size)
+
     def on_train_begin(self):
         self.iteration = 0
         self.epoch = 0
+        # Persistent buffers for the pre-step weights, reused every batch
+        self.param_groups_old = [[p.data.clone() for p in group['params']]
+                                 for group in self.layer_opt.opt.param_groups]
 
     def on_batch_begin(self):
         # Prepare for decay of weights
 
-        # Default weight decay (as provided by user)
-        wdn = self.init_wds
+        # Default weight decay (as provided by user), normalized per epoch if requested
+        wdn = self.epoch_wdn[self.epoch] if self.norm_wds else self.init_wds
 
         # Weight decay multiplier (The 'eta' in the paper). Optional.
         wdm = 1.0
         if self.wds_sched_mult is not None:
             wdm = self.wds_sched_mult(self)
 
-        # Weight decay normalized. Optional.
-        if self.norm_wds:
-            wdn = wdn / np.sqrt(self.batch_per_epoch * self.epoch_to_num_cycles[self.epoch])
-
         # Final wds
         self.new_wds = wdm * wdn
 
-        # Record the wds
-        self.wds_history.append(self.new_wds)
+        # Record the wds only when they change, so constant schedules stay O(epochs)
+        if not self.wds_history or np.any(self.wds_history[-1] != self.new_wds):
+            self.wds_history.append(self.new_wds)
 
         # Set weight_decay with zeros so that it is not applied in Adam, we will apply it outside in on_batch_end()
-        self.layer_opt.set_wds(torch.zeros(self.new_wds.size))
+        self.layer_opt.set_wds(self.zero_wds)
         # We have to save the existing weights before the optimizer changes the values
-        self.param_groups_old = copy.deepcopy(self.layer_opt.opt.param_groups)
+        for bufs, group in zip(self.param_groups_old, self.layer_opt.opt.param_groups):
+            for buf, p in zip(bufs, group['params']): buf.copy_(p.data)
         self.iteration += 1
 
     def on_batch_end(self, loss):
-        # Decay the weights
+        # Decay the weights in-place, fusing each group into a single multi-tensor call when available
         for group, group_old, wds in zip(self.layer_opt.opt.param_groups, self.param_groups_old, self.new_wds):
-            for p, p_old in zip(group['params'], group_old['params']):
-                if p.grad is None:
-                    continue
-                p.data = p.data.add(-wds, p_old.data)
+            pairs = [(p.data, p_old) for p, p_old in zip(group['params'], group_old) if p.grad is not None]
+            if not pairs: continue
+            datas, olds = zip(*pairs)
+            if hasattr(torch, '_foreach_add_'): torch._foreach_add_(datas, olds, alpha=-float(wds))
+            else:
+                for d, o in zip(datas, olds): d.add_(-wds, o)
 
     def on_epoch_end(self, metrics):
         self.epoch += 1
 
+def cos_anneal_cumsum(n, nb):
+    """Sum of the first n CosAnneal multipliers (cos(pi*i/nb)+1)/2, in closed form
+    (Dirichlet kernel identity), so schedulers thresholding on accumulated lr can
+    query any point in O(1) instead of materializing and summing the table.
+    n may be a scalar or an array of query points."""
+    s = np.sin(np.pi/(2*nb))
+    return 0.5*(n + (np.sin((2*n-1)*np.pi/(2*nb)) + s)/(2*s))
+
 def smooth_curve(vals, beta):
-    avg_val = 0
-    smoothed = []
-    for (i,v) in enumerate(vals):
-        avg_val = beta * avg_val + (1-beta) * v
-        smoothed.append(avg_val/(1-beta**(i+1)))
-    return smoothed
\ No newline at end of file
+    v = np.asarray(vals, dtype=np.float64)
+    if len(v)==0: return v
+    avg_vals = lfilter([1-beta], [1,-beta], v)
+    return avg_vals / (1 - beta**np.arange(1, len(v)+1))
\ No newline at end of file
@@ -0,0 +1,123 @@
+import numpy as np
+
+from fastai.layer_optimizer import LayerOptimizer
+from fastai.sgdr import CosAnneal, CircularLR, CircularLR_beta, _circ_beta_mult, _circ_beta_mom
+
+
+class Par(object):
+    def __init__(self, x, grad=True):
+        self.x = x
+        self.requires_grad = grad
+    def parameters(self): return [self]
+
+class FakeOpt(object):
+    def __init__(self, params): self.param_groups = params
+
+def layer_opt_(lr=1e-2): return LayerOptimizer(FakeOpt, [Par('A'), Par('B'), Par('C')], lr, 1e-4)
+
+def run_sched_(sched, n):
+    # Drive the scheduler the way fit does, capturing lr (and momentum) after each update
+    sched.on_train_begin()
+    lrs, moms = [sched.layer_opt.lr], [sched.layer_opt.mom if sched.record_mom else None]
+    for _ in range(n-1):
+        sched.on_batch_end(1.)
+        lrs.append(sched.layer_opt.lr)
+        moms.append(sched.layer_opt.mom if sched.record_mom else None)
+    return np.array(lrs), moms
+
+
+# Reference implementations: the original per-batch formulas, before the lookup tables
+
+def ref_cos_anneal_(lr, nb, cycle_mult, n):
+    cycle_iter, out = 0, []
+    for iteration in range(n):
+        if iteration < nb/20:
+            cycle_iter += 1
+            out.append(lr/100.)
+            continue
+        cos_out = np.cos(np.pi*cycle_iter/nb) + 1
+        cycle_iter += 1
+        if cycle_iter == nb:
+            cycle_iter = 0
+            nb *= cycle_mult
+        out.append(lr/2*cos_out)
+    return np.array(out)
+
+def ref_circular_(lr, nb, div, cut_div, moms, n):
+    cut_pt = nb//cut_div
+    cycle_iter, lrs, mms = 0, [], []
+    for _ in range(n):
+        if cycle_iter > cut_pt: pct = 1 - (cycle_iter - cut_pt)/(nb - cut_pt)
+        else: pct = cycle_iter/cut_pt
+        lrs.append(lr * (1 + pct*(div-1)) / div)
+        cycle_iter += 1
+        if cycle_iter == nb: cycle_iter = 0
+        if cycle_iter > cut_pt: mpct = (cycle_iter - cut_pt)/(nb - cut_pt)
+        else: mpct = 1 - cycle_iter/cut_pt
+        mms.append(moms[1] + mpct*(moms[0] - moms[1]))
+    return np.array(lrs), np.array(mms)
+
+def ref_circular_beta_(lr, nb, div, pct, moms, n):
+    cycle_nb = int(nb * (1-pct/100) / 2)
+    cycle_iter, lrs, mms = 0, [], []
+    for _ in range(n):
+        if cycle_iter > 2*cycle_nb:
+            p = (cycle_iter - 2*cycle_nb)/(nb - 2*cycle_nb)
+            lrs.append(lr * (1 + p*(1-100)/100) / div)
+        elif cycle_iter > cycle_nb:
+            p = 1 - (cycle_iter - cycle_nb)/cycle_nb
+            lrs.append(lr * (1 + p*(div-1)) / div)
+        else:
+            p = cycle_iter/cycle_nb
+            lrs.append(lr * (1 + p*(div-1)) / div)
+        cycle_iter += 1
+        if cycle_iter == nb: cycle_iter = 0
+        if moms is not None:
+            if cycle_iter > 2*cycle_nb: mms.append(moms[0])
+            elif cycle_iter > cycle_nb: mms.append(moms[0] + (1 - (cycle_iter - cycle_nb)/cycle_nb)*(moms[1] - moms[0]))
+            else: mms.append(moms[0] + cycle_iter/cycle_nb*(moms[1] - moms[0]))
+    return np.array(lrs), np.array(mms)
+
+
+def test_cos_anneal_matches_baseline_over_restart():
+    nb, cycle_mult, n = 40, 2, 40 + 80 + 5
+    lrs, _ = run_sched_(CosAnneal(layer_opt_(), nb, cycle_mult=cycle_mult), n)
+    np.testing.assert_allclose(lrs, ref_cos_anneal_(1e-2, nb, cycle_mult, n), rtol=1e-5)
+
+def test_cos_anneal_tiny_cycle_matches_baseline():
+    # Regression: the warmup branch can push cycle_iter past the table for nb=1
+    lrs, _ = run_sched_(CosAnneal(layer_opt_(), 1), 5)
+    np.testing.assert_allclose(lrs, ref_cos_anneal_(1e-2, 1, 1, 5), rtol=1e-5, atol=1e-12)
+
+def test_circular_lr_matches_baseline():
+    nb, div, cut_div, moms = 60, 4, 8, (0.95, 0.85)
+    n = 2*nb + 5
+    lrs, mms = run_sched_(CircularLR(layer_opt_(), nb, div=div, cut_div=cut_div, momentums=moms), n)
+    ref_lrs, ref_mms = ref_circular_(1e-2, nb, div, cut_div, moms, n)
+    np.testing.assert_allclose(lrs, ref_lrs, rtol=1e-5)
+    np.testing.assert_allclose(np.array(mms), ref_mms, rtol=1e-5)
+
+def test_circular_lr_beta_matches_baseline():
+    nb, div, pct, moms = 50, 10, 10, (0.95, 0.85)
+    n = nb + 7
+    lrs, mms = run_sched_(CircularLR_beta(layer_opt_(), nb, div=div, pct=pct, momentums=moms), n)
+    ref_lrs, ref_mms = ref_circular_beta_(1e-2, nb, div, pct, moms, n)
+    np.testing.assert_allclose(lrs, ref_lrs, rtol=1e-5)
+    np.testing.assert_allclose(np.array(mms), ref_mms, rtol=1e-5)
+
+def test_circular_beta_scalar_fallback_matches_tables():
+    sched = CircularLR_beta(layer_opt_(), 50, momentums=(0.95, 0.85))
+    sched.build_tables()
+    for it in range(sched.nb):
+        mult = _circ_beta_mult(it, sched.nb, sched.cycle_nb, sched.div)
+        np.testing.assert_allclose(mult, sched.lr_mult_tbl[it], rtol=1e-5)
+        mom = _circ_beta_mom(it, sched.cycle_nb, *sched.moms)
+        np.testing.assert_allclose(mom, sched.mom_tbl[it], rtol=1e-5)
+
+def test_circular_beta_huge_nb_uses_scalar_fallback():
+    nb = (1<<20) + 8
+    sched = CircularLR_beta(layer_opt_(), nb)
+    lrs, _ = run_sched_(sched, 5)
+    assert sched.lr_mult_tbl is None
+    ref_lrs, _ = ref_circular_beta_(1e-2, nb, sched.div, sched.pct, None, 5)
+    np.testing.assert_allclose(lrs, ref_lrs, rtol=1e-5)